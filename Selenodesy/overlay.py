@@ -0,0 +1,135 @@
+import cv2
+import numpy as np
+from scipy.special import hyp2f1
+
+from solver import A_LAT, axis_vectors, vertex_offsets
+
+EPS_PX = 0.25
+SHIFT = 4
+G_TABLE = 257
+
+
+def parabola_axes(P, m, C, a=A_LAT):
+    """rotated_parabola_points ile aynı parabol: X(t) = V + t*v + a*t^2*u."""
+    u, v = axis_vectors(float(m) if np.isfinite(m) else 0.0)
+    s = vertex_offsets(np.asarray(P, dtype=float)[None], m, C, a)[0]
+    V = np.asarray(C, dtype=float) + s * u
+    return V, u, v, a
+
+
+def fixed_vertex_axes(P, m, V):
+    """
+    rotated_parabola_points_fixed_vertex ile aynı: tepe V sabit, a = n / t^2 P'den geçecek şekilde.
+    Dönüş ayrıca P'nin bulunduğu yarı dalın işaretini verir.
+    """
+    u, v = axis_vectors(float(m) if np.isfinite(m) else 0.0)
+    V = np.asarray(V, dtype=float)
+    d = np.asarray(P, dtype=float) - V
+    t = float(v @ d)
+    if abs(t) < 1e-9:
+        t = 1e-3
+    a = float(u @ d) / (t * t)
+    return V, u, v, a, (1.0 if t > 0 else -1.0)
+
+
+def quad_roots(c2, c1, c0):
+    if abs(c2) < 1e-15:
+        return np.array([-c0 / c1]) if abs(c1) > 1e-15 else np.empty(0)
+    disc = c1 * c1 - 4.0 * c2 * c0
+    if disc < 0:
+        return np.empty(0)
+    # sayısal olarak kararlı form
+    q = -0.5 * (c1 + np.copysign(np.sqrt(disc), c1))
+    r = [q / c2]
+    if q != 0:
+        r.append(c0 / q)
+    return np.array(r)
+
+
+def visible_intervals(V, u, v, a, W, H, t_lo, t_hi):
+    """
+    X(t)'nin [0, W-1] x [0, H-1] kutusu içinde kaldığı t aralıkları; her koordinat t'de ikinci derece
+    olduğundan sınırlar kenar denklemlerinin kökleridir.
+    """
+    cuts = [t_lo, t_hi]
+    for k, hi in ((0, W - 1), (1, H - 1)):
+        for edge in (0.0, hi):
+            cuts.extend(quad_roots(a * u[k], v[k], V[k] - edge))
+    cuts = np.unique(np.clip(cuts, t_lo, t_hi))
+    if len(cuts) < 2:
+        return []
+
+    mid = 0.5 * (cuts[:-1] + cuts[1:])
+    pts = V + mid[:, None] * v + (a * mid * mid)[:, None] * u
+    inside = (pts[:, 0] >= 0) & (pts[:, 0] <= W - 1) & (pts[:, 1] >= 0) & (pts[:, 1] <= H - 1)
+
+    out = []
+    for t0, t1, ok in zip(cuts[:-1], cuts[1:], inside):
+        if not ok:
+            continue
+        if out and out[-1][1] == t0:
+            out[-1] = (out[-1][0], t1)
+        else:
+            out.append((t0, t1))
+    return out
+
+
+def curvature_integral(w):
+    """G(w) = int_0^w (1 + x^2)^(-1/4) dx."""
+    return w * hyp2f1(0.25, 0.5, 1.5, -w * w)
+
+
+def sample_interval(V, u, v, a, t0, t1, eps=EPS_PX):
+    """
+    Kiriş sapması eps pikseli geçmeyecek kadar nokta; ardışık noktalar eğrilik integralinde eşit aralıklı.
+    Segment sayısı N = (G(w1) - G(w0)) / (sqrt(8*eps) * sqrt(2|a|)), w = 2|a|t.
+    """
+    aa = abs(a)
+    if aa < 1e-12:
+        t = np.array([t0, t1])
+    else:
+        w0, w1 = 2 * aa * t0, 2 * aa * t1
+        g0, g1 = curvature_integral(w0), curvature_integral(w1)
+        n = max(1, int(np.ceil((g1 - g0) / (np.sqrt(8 * eps) * np.sqrt(2 * aa)))))
+        w_tab = np.linspace(w0, w1, G_TABLE)
+        t = np.interp(np.linspace(g0, g1, n + 1), curvature_integral(w_tab), w_tab) / (2 * aa)
+        t[0], t[-1] = t0, t1
+    return V + t[:, None] * v + (a * t * t)[:, None] * u
+
+
+class ParabolaOverlay(object):
+    """
+    Bir karenin parabollerini toplar; render() her (renk, kalınlık) için tek cv2.polylines çağrısı yapar.
+    """
+
+    def __init__(self, W, H, eps=EPS_PX, line_type=cv2.LINE_AA):
+        self.W, self.H = W, H
+        self.eps = eps
+        self.line_type = line_type
+        self.groups = {}
+
+    def add_curve(self, V, u, v, a, t_lo, t_hi, color, thickness=2):
+        key = (tuple(int(c) for c in color), int(thickness))
+        polys = self.groups.setdefault(key, [])
+        for t0, t1 in visible_intervals(V, u, v, a, self.W, self.H, t_lo, t_hi):
+            pts = sample_interval(V, u, v, a, t0, t1, self.eps)
+            polys.append(np.round(pts * (1 << SHIFT)).astype(np.int32).reshape(-1, 1, 2))
+        return self
+
+    def add_parabola(self, P, m, C, a=A_LAT, color=(255, 255, 255), thickness=2):
+        V, u, v, a = parabola_axes(P, m, C, a)
+        T = max(self.W, self.H) * 1.5
+        return self.add_curve(V, u, v, a, -T, T, color, thickness)
+
+    def add_fixed_vertex(self, P, m, V, color=(255, 255, 255), thickness=2):
+        V, u, v, a, side = fixed_vertex_axes(P, m, V)
+        T = 2.0 * max(self.W, self.H)
+        t_lo, t_hi = (0.0, T) if side > 0 else (-T, 0.0)
+        return self.add_curve(V, u, v, a, t_lo, t_hi, color, thickness)
+
+    def render(self, img_rgb):
+        for (color, thickness), polys in self.groups.items():
+            if polys:
+                cv2.polylines(img_rgb, polys, isClosed=False, color=color, thickness=thickness,
+                              lineType=self.line_type, shift=SHIFT)
+        return img_rgb
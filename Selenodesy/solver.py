@@ -0,0 +1,374 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import brentq
+
+A_LAT = 0.001
+MOON_RADIUS_KM = 1737.0
+
+
+def slope_grid(lo=-20.0, hi=20.0, fine_lo=-5.0, fine_hi=5.0, fine_step=0.001, coarse_step=1.0):
+    return np.concatenate([
+        np.arange(lo, fine_lo, coarse_step),
+        np.arange(fine_lo, fine_hi + 1e-4, fine_step),
+        np.arange(fine_hi + coarse_step, hi + coarse_step, coarse_step),
+    ])
+
+
+def axis_vectors(m):
+    """
+    Merkez-boylam doğrusu y = m*x + b için birim eksen u = (1, m)/|.| ve normal v = (-m, 1)/|.|.
+    m dizisi (...,) -> u, v (..., 2).
+    """
+    m = np.asarray(m, dtype=float)
+    norm = np.hypot(1.0, m)
+    u = np.stack([1.0 / norm, m / norm], axis=-1)
+    v = np.stack([-m / norm, 1.0 / norm], axis=-1)
+    return u, v
+
+
+def vertex_offsets(P, m, C, a=A_LAT):
+    """
+    Tepe noktası C + s*u olan parabolün s değeri; P (K, 2) noktaları, m (N,) eğimleri için (N, K).
+    Çoklu kare: P (F, K, 2), C (F, 2), m (M, 1) -> (M, F, K).
+    vertex_rotated ile aynı: s = u.(P-C) - a*(v.(P-C))^2
+    """
+    P = np.asarray(P, dtype=float)
+    C = np.asarray(C, dtype=float)
+    m = np.asarray(m, dtype=float)[..., None]
+    dx, dy = P[..., 0] - C[..., None, 0], P[..., 1] - C[..., None, 1]
+    n2 = 1.0 + m * m
+    n0 = (dx + m * dy) / np.sqrt(n2)
+    t0_sq = (dy - m * dx) ** 2 / n2
+    return n0 - a * t0_sq
+
+
+def parabola_vertices(P, m, C, a=A_LAT):
+    s = vertex_offsets(P, m, C, a)
+    u, _ = axis_vectors(m)
+    return np.asarray(C, dtype=float) + s[..., None] * u[..., None, :]
+
+
+def vertex_distance_sweep(p_main, p_ast1, p_ast2, A_vals, C, a=A_LAT):
+    # all three vertices lie on the same axis through C, so |V_i - V_main| = |s_i - s_main|
+    s = vertex_offsets(np.stack([p_main, p_ast1, p_ast2]), A_vals, C, a)
+    d1 = np.abs(s[:, 1] - s[:, 0])
+    d2 = np.abs(s[:, 2] - s[:, 0])
+    ratio = np.divide(d1, d2, out=np.full_like(d1, np.nan), where=(d2 != 0))
+    return d1, d2, ratio
+
+
+SEGMENT_DTYPE = np.dtype([("A", float), ("B", float), ("x1", float), ("y1", float),
+                          ("x2", float), ("y2", float), ("valid", bool)])
+
+
+def segments_through_center(A_vals, cx, cy, W, H, tol=1e-6):
+    """
+    y = A*x + B doğrusunun (cx, cy)'den geçen ve [0, W-1] x [0, H-1] kutusuyla kesişen parçası, tüm eğimler için.
+    Aday kenar sırası eski fonksiyonla aynı: sol, sağ, üst, alt; köşede çakışan adaylar tol ile elenir.
+    Dönüş: SEGMENT_DTYPE yapılı dizi (N,); kesişim yoksa valid=False ve uçlar nan.
+    """
+    A = np.atleast_1d(np.asarray(A_vals, dtype=float))
+    B = cy - A * cx
+    xr, yb = W - 1, H - 1
+    nz = np.abs(A) > 1e-12
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x_top = np.where(nz, -B / A, np.nan)
+        x_bottom = np.where(nz, (yb - B) / A, np.nan)
+    y_right = A * xr + B
+
+    # (N, 4, 2) adaylar: sol, sağ, üst, alt
+    cand = np.empty(A.shape + (4, 2))
+    cand[:, 0, 0], cand[:, 0, 1] = 0.0, B
+    cand[:, 1, 0], cand[:, 1, 1] = xr, y_right
+    cand[:, 2, 0], cand[:, 2, 1] = x_top, 0.0
+    cand[:, 3, 0], cand[:, 3, 1] = x_bottom, yb
+    inside = np.stack([
+        (B >= 0) & (B <= yb),
+        (y_right >= 0) & (y_right <= yb),
+        nz & (x_top >= 0) & (x_top <= xr),
+        nz & (x_bottom >= 0) & (x_bottom <= xr),
+    ], axis=1)
+
+    keep = inside.copy()
+    for j in range(1, 4):
+        close = np.all(np.abs(cand[:, :j] - cand[:, j:j + 1]) < tol, axis=-1)
+        keep[:, j] &= ~np.any(keep[:, :j] & close, axis=1)
+
+    order = np.argsort(~keep, axis=1, kind="stable")[:, :2]
+    rows = np.arange(len(A))[:, None]
+    ends = cand[rows, order]
+    valid = keep.sum(axis=1) >= 2
+
+    seg = np.empty(len(A), dtype=SEGMENT_DTYPE)
+    seg["A"], seg["B"], seg["valid"] = A, B, valid
+    seg["x1"], seg["y1"] = np.where(valid, ends[:, 0, 0], np.nan), np.where(valid, ends[:, 0, 1], np.nan)
+    seg["x2"], seg["y2"] = np.where(valid, ends[:, 1, 0], np.nan), np.where(valid, ends[:, 1, 1], np.nan)
+    return seg
+
+
+def segment_through_center(A, cx, cy, W, H):
+    """Tek eğim için eski arayüz: (x1, y1), (x2, y2), B; kesişim yoksa None, None, B."""
+    seg = segments_through_center(A, cx, cy, W, H)[0]
+    if not seg["valid"]:
+        return None, None, float(seg["B"])
+    return (float(seg["x1"]), float(seg["y1"])), (float(seg["x2"]), float(seg["y2"])), float(seg["B"])
+
+
+def segments_frame(seg, a_col="A", b_col="B"):
+    df = pd.DataFrame({name: seg[name][seg["valid"]] for name in ("A", "B", "x1", "y1", "x2", "y2")})
+    return df.rename(columns={"A": a_col, "B": b_col})
+
+
+def lat_arc_km(phi1_deg, phi2_deg, R=MOON_RADIUS_KM):
+    return np.abs(np.radians(np.asarray(phi1_deg, dtype=float) - phi2_deg)) * R
+
+
+def vertex_offset_slopes(P, m, C, a=A_LAT):
+    """
+    ds/dm, vertex_offsets ile aynı şekil.
+    ds/dm = (dy - m*dx)/(1+m^2)^(3/2) + 2a*(dy - m*dx)*(dx + m*dy)/(1+m^2)^2
+    """
+    P = np.asarray(P, dtype=float)
+    C = np.asarray(C, dtype=float)
+    m = np.asarray(m, dtype=float)[..., None]
+    dx, dy = P[..., 0] - C[..., None, 0], P[..., 1] - C[..., None, 1]
+    n2 = 1.0 + m * m
+    t = dy - m * dx
+    return t / (n2 * np.sqrt(n2)) + 2.0 * a * t * (dx + m * dy) / (n2 * n2)
+
+
+def ratio_roots(p_main, p_ast1, p_ast2, target, C, a=A_LAT, lo=-20.0, hi=20.0, n_bracket=16, xtol=1e-15,
+                max_split=6):
+    """
+    ratio(A) = target denkleminin [lo, hi] aralığındaki tüm kökleri.
+    Kökler g = |D1| - target*|D2| üzerinde aranır, D_i = s_i - s_main (d2 -> 0 kutuplarında sonsuz değer olmaz).
+    Kaba ızgara atan(A) uzayında eşit aralıklı. Izgaraya sırasıyla eklenir:
+      - D_i = 0 kırılma noktaları (her hücrede g düzgün olur),
+      - uç değer ve türevlerden kurulan Hermite kübiği hücre içinde sıfırı geçiyorsa hücrenin ortası
+        (en çok max_split kez; tek hücrede gizli çift kesişimler için),
+      - g' = 0 ekstremumları (aynı hücreye düşen iki kök ayrı aralıklara ayrılır).
+    İşaret değişimi olan her aralık brentq ile inceltilir.
+    Sınır: bir hücrede D_i'nin iki sıfırı ya da Hermite kübiğinin göremeyeceği kadar dar bir çift kesişim kalırsa
+    bu kökler atlanır; n_bracket artırılarak daraltılabilir.
+    Dönüş: roots, theta_deg = degrees(atan(A)), residual = ratio - target, n_eval (D ve dD nokta sayısı)
+    """
+    P = np.stack([p_main, p_ast1, p_ast2])
+    n_eval = [0]
+    rtol = 4 * np.finfo(float).eps
+
+    def D(A):
+        n_eval[0] += np.size(A)
+        s = vertex_offsets(P, A, C, a)
+        return s[..., 1:] - s[..., :1]
+
+    def dD(A):
+        n_eval[0] += np.size(A)
+        ds = vertex_offset_slopes(P, A, C, a)
+        return ds[..., 1:] - ds[..., :1]
+
+    def g(A):
+        d = D(A)
+        return np.abs(d[..., 0]) - target * np.abs(d[..., 1])
+
+    if not np.isfinite(target):
+        empty = np.empty(0)
+        return empty, empty, empty, 0
+
+    def insert(A, Dg, Pg, x):
+        if len(x) == 0:
+            return A, Dg, Pg
+        x = np.asarray(x, dtype=float)
+        A = np.concatenate([A, x])
+        Dg = np.concatenate([Dg, D(x)])
+        Pg = np.concatenate([Pg, dD(x)])
+        A, keep = np.unique(A, return_index=True)
+        return A, Dg[keep], Pg[keep]
+
+    def branches(A, Dg, Pg):
+        # kırılmalar ızgara noktası olduğundan D hücre içinde işaret değiştirmez; kırılma ucunda D ~ 0
+        sg = w * np.sign(Dg[:-1] + Dg[1:])
+        return ((sg * Dg[:-1]).sum(axis=1), (sg * Dg[1:]).sum(axis=1),
+                (sg * Pg[:-1]).sum(axis=1), (sg * Pg[1:]).sum(axis=1), sg)
+
+    w = np.array([1.0, -target])
+    A = np.tan(np.linspace(np.arctan(lo), np.arctan(hi), n_bracket))
+    A[0], A[-1] = lo, hi
+    Dg, Pg = D(A), dD(A)
+
+    kinks = []
+    for k in range(2):
+        for i in np.flatnonzero(np.sign(Dg[:-1, k]) * np.sign(Dg[1:, k]) < 0):
+            kinks.append(brentq(lambda x: D(x)[k], A[i], A[i + 1], xtol=xtol, rtol=rtol))
+    A, Dg, Pg = insert(A, Dg, Pg, kinks)
+
+    u = np.linspace(0.0, 1.0, 9)[1:-1, None]
+    h00, h10 = 2 * u**3 - 3 * u**2 + 1, u**3 - 2 * u**2 + u
+    h01, h11 = -2 * u**3 + 3 * u**2, u**3 - u**2
+    for _ in range(max_split):
+        g0, g1, p0, p1, _ = branches(A, Dg, Pg)
+        L = np.diff(A)
+        cubic = h00 * g0 + h10 * L * p0 + h01 * g1 + h11 * L * p1
+        same = np.sign(g0) * np.sign(g1) > 0
+        hidden = same & (np.sign(p0) * np.sign(p1) >= 0) & (np.sign(cubic) != np.sign(g0)).any(axis=0)
+        if not hidden.any():
+            break
+        A, Dg, Pg = insert(A, Dg, Pg, 0.5 * (A[:-1] + A[1:])[hidden])
+
+    g0, g1, p0, p1, sg = branches(A, Dg, Pg)
+    extrema = []
+    for i in np.flatnonzero((np.sign(g0) * np.sign(g1) > 0) & (np.sign(p0) * np.sign(p1) < 0)):
+        extrema.append(brentq(lambda x, s=sg[i]: (s * dD(x)).sum(), A[i], A[i + 1], xtol=xtol, rtol=rtol))
+    extrema = np.asarray(extrema, dtype=float)
+    A, Dg, Pg = insert(A, Dg, Pg, extrema)
+
+    G = np.abs(Dg[:, 0]) - target * np.abs(Dg[:, 1])
+    ok = np.isfinite(G)
+    A, G, Dg = A[ok], G[ok], Dg[ok]
+
+    roots = list(A[G == 0])
+    # teğet kökler: işaret değiştirmeyen ama sıfıra değen ekstremumlar
+    if extrema.size:
+        at = np.isin(A, extrema)
+        roots.extend(A[at & (np.abs(G) <= 1e-9 * (1.0 + np.abs(Dg).sum(axis=-1)))])
+    for i in np.flatnonzero(np.sign(G[:-1]) * np.sign(G[1:]) < 0):
+        roots.append(brentq(g, A[i], A[i + 1], xtol=xtol, rtol=rtol))
+
+    roots = np.unique(np.asarray(roots, dtype=float))
+    _, _, r = vertex_distance_sweep(p_main, p_ast1, p_ast2, roots, C, a)
+    keep = np.isfinite(r)
+    roots = roots[keep]
+    return roots, np.degrees(np.arctan(roots)), r[keep] - target, n_eval[0]
+
+
+# BATCH
+
+PARALLEL_MIN_FRAMES = 64
+RATIO_CAP = 10.0
+CURVE_CHUNK = 1 << 22
+
+
+def frames_to_arrays(frames):
+    """
+    Notebook formatındaki kareler -> dizi. Karelerdeki nokta sayısı farklı olabilir (landmarks_to_points);
+    eksik yerler nan ile doldurulur, K = max(3, en çok nokta).
+    frames: [{"points": [{"pixel": (x, y), "lat": ..}, ...], "center": (cx, cy)}, ...]
+    Dönüş: pixels (N, K, 2), lat (N, K), centers (N, 2)
+    """
+    K = max([3] + [len(f["points"]) for f in frames])
+    pixels = np.full((len(frames), K, 2), np.nan)
+    lat = np.full((len(frames), K), np.nan)
+    for i, f in enumerate(frames):
+        n = len(f["points"])
+        if n:
+            pixels[i, :n] = [pt["pixel"] for pt in f["points"]]
+            lat[i, :n] = [pt["lat"] for pt in f["points"]]
+    centers = np.array([f["center"] for f in frames], dtype=float).reshape(-1, 2)
+    return pixels, lat, centers
+
+
+def assign_roles(pixels, centers):
+    """
+    Merkeze en yakın nokta main, sonraki iki nokta assistant1 / assistant2.
+    pixels (N, K, 2), centers (N, 2) -> idx (N, 3) = [main, ast1, ast2]
+    nan doldurulmuş noktalar sıralamada sona düşer.
+    """
+    pixels = np.asarray(pixels, dtype=float)
+    centers = np.asarray(centers, dtype=float)
+    if pixels.shape[-2] < 3:
+        raise ValueError("En az iki assistant point gerekiyor.")
+    dist = np.linalg.norm(pixels - centers[..., None, :], axis=-1)
+    return np.argsort(dist, axis=-1, kind="stable")[..., :3]
+
+
+def batch_ratio_curves(P, A_vals, centers, a=A_LAT):
+    """
+    P (N, 3, 2) [main, ast1, ast2] pikselleri, A_vals (M,) -> d1, d2, ratio (N, M).
+    Ara diziler CURVE_CHUNK elemanı geçmesin diye kareler parça parça işlenir.
+    """
+    P = np.asarray(P, dtype=float)
+    centers = np.asarray(centers, dtype=float)
+    A_vals = np.asarray(A_vals, dtype=float)
+    N, M = len(P), len(A_vals)
+    d1 = np.empty((N, M))
+    d2 = np.empty((N, M))
+    step = max(1, CURVE_CHUNK // max(1, 3 * M))
+    for i in range(0, N, step):
+        s = vertex_offsets(P[i:i + step], A_vals[:, None], centers[i:i + step], a)
+        d1[i:i + step] = np.abs(s[..., 1] - s[..., 0]).T
+        d2[i:i + step] = np.abs(s[..., 2] - s[..., 0]).T
+    ratio = np.divide(d1, d2, out=np.full_like(d1, np.nan), where=(d2 != 0))
+    return d1, d2, ratio
+
+
+def frame_roots(job):
+    i, P, target, C, a = job
+    roots, theta, res, n_eval = ratio_roots(P[0], P[1], P[2], target, C, a)
+    return i, roots, theta, res, n_eval
+
+
+def batch_roots(P, targets, centers, a=A_LAT, workers=None, min_parallel=PARALLEL_MIN_FRAMES, frames=None):
+    """
+    Her kare için ratio_roots; iş sayısı >= min_parallel ise ProcessPoolExecutor ile.
+    frames verilirse yalnız bu kare indeksleri çözülür.
+    Dönüş: DataFrame [frame, A_cl, theta_deg, residual] ve kare başına değerlendirme sayısı (N,)
+    """
+    frames = range(len(P)) if frames is None else frames
+    jobs = [(i, P[i], float(targets[i]), centers[i], a) for i in frames]
+    if len(jobs) >= min_parallel:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(frame_roots, jobs, chunksize=max(1, len(jobs) // (4 * workers))))
+    else:
+        results = [frame_roots(job) for job in jobs]
+
+    n_eval = np.zeros(len(P), dtype=np.int64)
+    ids, roots, theta, res = [], [], [], []
+    for i, r, th, rs, n in results:
+        n_eval[i] = n
+        ids.append(np.full(len(r), i, dtype=np.int64))
+        roots.append(r); theta.append(th); res.append(rs)
+    df = pd.DataFrame({
+        "frame": np.concatenate(ids) if ids else np.empty(0, dtype=np.int64),
+        "A_cl": np.concatenate(roots) if roots else np.empty(0),
+        "theta_deg": np.concatenate(theta) if theta else np.empty(0),
+        "residual": np.concatenate(res) if res else np.empty(0),
+    })
+    return df, n_eval
+
+
+def batch_attitude(pixels, lat, centers, A_vals=None, a=A_LAT, curves=True, workers=None,
+                   min_parallel=PARALLEL_MIN_FRAMES, R=MOON_RADIUS_KM, ratio_cap=RATIO_CAP):
+    """
+    N kare için üç nokta yöntemi: roller, gerçek enlem oranı, oran eğrileri ve kökler.
+    pixels (N, K, 2), lat (N, K), centers (N, 2); nan noktalar yok sayılır (frames_to_arrays).
+    Enlemi nan olan noktalar sıralamaya girmez. Üçten az noktası olan karelerde roles = -1, P / oranlar nan
+    ve kök yok. Kökler notebook'taki gibi min(real_lat_ratio, ratio_cap) hedefi için çözülür.
+    """
+    pixels = np.asarray(pixels, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    centers = np.asarray(centers, dtype=float)
+    rows = np.arange(len(pixels))[:, None]
+
+    usable = np.isfinite(pixels).all(axis=-1) & np.isfinite(lat)
+    pixels = np.where(usable[..., None], pixels, np.nan)
+    valid = usable.sum(axis=1) >= 3
+    idx = np.where(valid[:, None], assign_roles(pixels, centers), -1)
+    P = np.where(valid[:, None, None], pixels[rows, idx], np.nan)
+    phi = np.where(valid[:, None], lat[rows, idx], np.nan)
+    d1_lat = lat_arc_km(phi[:, 0], phi[:, 1], R)
+    d2_lat = lat_arc_km(phi[:, 0], phi[:, 2], R)
+    real_lat_ratio = np.divide(d1_lat, d2_lat, out=np.full_like(d1_lat, np.nan), where=(d2_lat != 0))
+
+    target = np.minimum(real_lat_ratio, ratio_cap)
+
+    out = {"roles": idx, "valid": valid, "P": P, "real_lat_ratio": real_lat_ratio, "target": target}
+    if curves:
+        A_vals = slope_grid() if A_vals is None else np.asarray(A_vals, dtype=float)
+        out["A_vals"] = A_vals
+        out["d1"], out["d2"], out["ratio"] = batch_ratio_curves(P, A_vals, centers, a)
+    out["roots"], out["n_eval"] = batch_roots(P, target, centers, a, workers, min_parallel,
+                                              frames=np.flatnonzero(valid))
+    return out
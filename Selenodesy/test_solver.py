@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.optimize import minimize_scalar
+
+from solver import RATIO_CAP, batch_attitude, ratio_roots, slope_grid, vertex_distance_sweep
+
+
+def dense_crossings(A_vals, ratio, target):
+    ok = np.isfinite(ratio)
+    A, Y = np.asarray(A_vals)[ok], ratio[ok] - target
+    i = np.flatnonzero(np.sign(Y[:-1]) * np.sign(Y[1:]) < 0)
+    return A[i] - Y[i] * (A[i + 1] - A[i]) / (Y[i + 1] - Y[i]), A[i + 1] - A[i]
+
+
+def random_case(rng):
+    return rng.random((3, 2)) * 1024, np.array([512.0, 400.0]), rng.choice([0.001, 0.003, 0.0003])
+
+
+def test_ratio_roots_matches_dense_sweep():
+    rng = np.random.default_rng(1)
+    grid = slope_grid()
+    evals = []
+    for _ in range(300):
+        P, C, a = random_case(rng)
+        target = rng.uniform(0.1, 5)
+        _, _, ratio = vertex_distance_sweep(*P, grid, C, a)
+        roots, theta, res, n_eval = ratio_roots(*P, target, C, a)
+        assert np.all(np.abs(res) < 1e-8)
+        np.testing.assert_allclose(theta, np.degrees(np.arctan(roots)))
+        evals.append(n_eval)
+        for x, step in zip(*dense_crossings(grid, ratio, target)):
+            assert len(roots) and np.abs(roots - x).min() <= 2 * step
+    assert np.mean(evals) < len(grid) / 100
+
+
+def test_ratio_roots_finds_narrow_pairs():
+    # target just below a local peak of the ratio curve: two roots inside one coarse cell
+    rng = np.random.default_rng(7)
+    grid = np.tan(np.linspace(np.arctan(-20), np.arctan(20), 20001))
+    checked = 0
+    while checked < 40:
+        P, C, a = random_case(rng)
+        _, _, R = vertex_distance_sweep(*P, grid, C, a)
+        ok = np.isfinite(R[1:-1]) & np.isfinite(R[:-2]) & np.isfinite(R[2:])
+        peaks = np.flatnonzero(ok & (R[1:-1] > R[:-2]) & (R[1:-1] > R[2:]) & (R[1:-1] < 50)) + 1
+        for j in peaks:
+            m = minimize_scalar(lambda x: -vertex_distance_sweep(*P, np.array([x]), C, a)[2][0],
+                                bounds=(grid[j - 1], grid[j + 1]), method="bounded", options={"xatol": 1e-14})
+            target = -m.fun * (1 - 1e-6)
+            if target > 50:
+                continue
+            roots, _, res, _ = ratio_roots(*P, target, C, a)
+            assert np.all(np.abs(res) < 1e-8)
+            left, right = roots[roots < m.x], roots[roots > m.x]
+            assert len(left) and len(right)
+            checked += 1
+
+
+def test_batch_attitude_skips_nan_lat_and_caps_target():
+    pixels = np.array([[[400, 401], [410, 400], [600, 300], [200, 500], [100, 100.]]])
+    lat = np.array([[np.nan, -10, -20, -10.0001, -50]])
+    out = batch_attitude(pixels, lat, np.array([[400, 400.]]), curves=False)
+    assert out["valid"][0] and -1 not in out["roles"][0] and 0 not in out["roles"][0]
+    assert out["real_lat_ratio"][0] > RATIO_CAP and out["target"][0] == RATIO_CAP
+    expected = ratio_roots(*out["P"][0], RATIO_CAP, np.array([400, 400.]))[0]
+    np.testing.assert_allclose(np.sort(out["roots"]["A_cl"].to_numpy()), np.sort(expected))